@@ -1,16 +1,25 @@
+import atexit
 import csv
 import hashlib
+import hmac
 import io
 import os
+import queue
 import secrets
 import smtplib
+import string
+import tempfile
+import threading
 import time
 from datetime import datetime, timedelta
 from email.message import EmailMessage
+from functools import lru_cache
 
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from dotenv import load_dotenv
-from flask import (Flask, flash, redirect, render_template, request, send_file,
-                   session, url_for)
+from flask import (Flask, Response, flash, redirect, render_template, request,
+                   send_file, session, stream_with_context, url_for)
 from flask_login import (LoginManager, UserMixin, current_user, login_required,
                          login_user, logout_user)
 from flask_sqlalchemy import SQLAlchemy
@@ -19,7 +28,10 @@ from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import re
 import requests
-from werkzeug.security import check_password_hash, generate_password_hash
+from requests.adapters import HTTPAdapter
+from sqlalchemy import and_, event, func
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import check_password_hash
 
 try:
     from reportlab.lib.pagesizes import letter
@@ -32,11 +44,43 @@ except ImportError:  # pragma: no cover - optional dependency for pdf export
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(BASE_DIR, ".env"))
 DB_PATH = os.path.join(BASE_DIR, "app.db")
+SCHEMA_VERSION = 3
+PLAN_CACHE_TTL = 300
+ADMIN_USERS_PER_PAGE = 50
+RECENT_TOLL_LIMIT = 100
+SECRET_KEY_PATH = os.path.join(BASE_DIR, ".secret_key")
+
+
+def load_secret_key() -> str:
+    if os.environ.get("SECRET_KEY"):
+        return os.environ["SECRET_KEY"]
+    # Persist a generated key so restarts don't invalidate every session.
+    # The key is written to a temp file and linked into place, so concurrent
+    # workers never see a partially written file and all end up with one key.
+    if not os.path.exists(SECRET_KEY_PATH):
+        fd, tmp_path = tempfile.mkstemp(dir=BASE_DIR, prefix=".secret_key.")
+        try:
+            with os.fdopen(fd, "w") as key_file:
+                key_file.write(secrets.token_hex(32))
+            os.link(tmp_path, SECRET_KEY_PATH)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp_path)
+    with open(SECRET_KEY_PATH) as key_file:
+        return key_file.read().strip()
+
 
 app = Flask(__name__)
-app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", os.urandom(32).hex())
+app.config["SECRET_KEY"] = load_secret_key()
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DB_PATH}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": 10,
+    "pool_pre_ping": True,
+    "pool_recycle": 1800,
+    "connect_args": {"check_same_thread": False},
+}
 app.config["WTF_CSRF_TIME_LIMIT"] = 3600
 app.config["SESSION_COOKIE_HTTPONLY"] = True
 app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
@@ -50,6 +94,27 @@ login_manager.login_view = "login"
 csrf = CSRFProtect(app)
 limiter = Limiter(get_remote_address, app=app, default_limits=["200 per day", "50 per hour"])
 
+_PLAN_NAMES: frozenset[str] = frozenset()
+_plans_cache = {"plans": None, "loaded_at": 0.0}
+_export_cache = {"entry": None}
+_matched_cache: dict = {}
+MATCHED_CACHE_SIZE = 64
+_FIELD_RE = re.compile(r"^([^:\n]*):(.*)$", re.MULTILINE)
+_CHUNK_DELIMITER_RE = re.compile(r"-{5,}")
+_password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+_DUMMY_HASH = _password_hasher.hash("!invalid-dummy!")
+
+_mail_queue: queue.Queue = queue.Queue()
+_mail_worker = None
+_mail_worker_lock = threading.Lock()
+
+_turnstile_session = requests.Session()
+_turnstile_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+_smtp_local = threading.local()
+_smtp_connections: set[smtplib.SMTP] = set()
+_smtp_lock = threading.Lock()
+
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -64,11 +129,25 @@ class User(UserMixin, db.Model):
     verification_token_hash = db.Column(db.String(64))
     verification_sent_at = db.Column(db.DateTime)
 
+    __table_args__ = (db.Index("ix_user_verif_hash", "verification_token_hash"),)
+
     def set_password(self, password: str) -> None:
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = _password_hasher.hash(password)
 
     def check_password(self, password: str) -> bool:
-        return check_password_hash(self.password_hash, password)
+        if not self.password_hash.startswith("$argon2"):
+            # Legacy Werkzeug hash: upgrade it on the first successful login.
+            if not check_password_hash(self.password_hash, password):
+                return False
+            self.set_password(password)
+            return True
+        try:
+            _password_hasher.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if _password_hasher.check_needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
 
 class ReservationEmail(db.Model):
@@ -81,6 +160,12 @@ class ReservationEmail(db.Model):
     state = db.Column(db.String(50), default="CO")
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_resv_plate_dates", "plate", "start_date", "end_date"),
+        db.Index("ix_resv_start_date", "start_date"),
+        db.Index("ix_resv_end_date", "end_date"),
+    )
+
 
 class Plan(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -99,10 +184,15 @@ class TollRecord(db.Model):
     state = db.Column(db.String(50), default="CO")
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_toll_plate_entry", "plate", "entry_time"),
+        db.Index("ix_toll_entry_time", "entry_time"),
+    )
+
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
 
 def ensure_user_columns():
@@ -116,11 +206,64 @@ def ensure_user_columns():
             conn.exec_driver_sql("ALTER TABLE user ADD COLUMN verification_token_hash VARCHAR(64)")
         if "verification_sent_at" not in cols:
             conn.exec_driver_sql("ALTER TABLE user ADD COLUMN verification_sent_at DATETIME")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_user_verif_hash ON user (verification_token_hash)")
+
+
+def ensure_match_indexes():
+    # Matching compares plates with plain equality so the indexes apply.
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql("UPDATE reservation_email SET plate = UPPER(plate) WHERE plate != UPPER(plate)")
+        conn.exec_driver_sql("UPDATE toll_record SET plate = UPPER(plate) WHERE plate != UPPER(plate)")
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_resv_plate_dates ON reservation_email (plate, start_date, end_date)"
+        )
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_resv_start_date ON reservation_email (start_date)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_resv_end_date ON reservation_email (end_date)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_toll_plate_entry ON toll_record (plate, entry_time)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_toll_entry_time ON toll_record (entry_time)")
+
+
+def refresh_plans():
+    global _PLAN_NAMES
+    plans = [
+        {"id": plan.id, "name": plan.name, "price": plan.price}
+        for plan in Plan.query.order_by(Plan.price.asc())
+    ]
+    _plans_cache.update(plans=plans, loaded_at=time.time())
+    # Rebind rather than mutate, so concurrent requests never see a partial set.
+    _PLAN_NAMES = frozenset(plan["name"] for plan in plans)
+
+
+def get_plans():
+    if _plans_cache["plans"] is None or time.time() - _plans_cache["loaded_at"] > PLAN_CACHE_TTL:
+        refresh_plans()
+    return _plans_cache["plans"]
+
+
+def migrate_database():
+    with db.engine.connect() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+    if version >= SCHEMA_VERSION:
+        return
+    ensure_user_columns()
+    ensure_match_indexes()
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
 
 
 def initialize_database():
+    event.listen(db.engine, "connect", set_sqlite_pragmas)
     db.create_all()
-    ensure_user_columns()
+    migrate_database()
     if Plan.query.count() == 0:
         db.session.add_all(
             [
@@ -130,6 +273,7 @@ def initialize_database():
             ]
         )
         db.session.commit()
+    refresh_plans()
     admin_email = os.environ.get("ADMIN_EMAIL")
     admin_password = os.environ.get("ADMIN_PASSWORD")
     if admin_email and admin_password and not User.query.filter_by(role="admin").first():
@@ -170,7 +314,7 @@ def signup():
         if not turnstile_secret:
             flash("Captcha is not configured.", "error")
             return redirect(url_for("signup"))
-        verify = requests.post(
+        verify = _turnstile_session.post(
             "https://challenges.cloudflare.com/turnstile/v0/siteverify",
             data={
                 "secret": turnstile_secret,
@@ -187,11 +331,8 @@ def signup():
         password = request.form.get("password", "")
         plan = request.form.get("plan", "Colorado Starter")
         fleet_size = int(request.form.get("fleet_size", 1))
-        if not Plan.query.filter_by(name=plan).first():
+        if plan not in _PLAN_NAMES:
             plan = "Colorado Starter"
-        if User.query.filter_by(email=email).first():
-            flash("Email already registered.", "error")
-            return redirect(url_for("signup"))
         if not is_strong_password(password):
             flash("Password must be at least 8 characters and include a letter and a number.", "error")
             return redirect(url_for("signup"))
@@ -201,12 +342,17 @@ def signup():
         user.verification_token_hash = token_hash
         user.verification_sent_at = datetime.utcnow()
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash("Email already registered.", "error")
+            return redirect(url_for("signup"))
         send_verification_email(user.email, token)
         flash("Check your email to verify your account before logging in.", "success")
         return redirect(url_for("login"))
     session["signup_ts"] = time.time()
-    plans = Plan.query.order_by(Plan.price.asc()).all()
+    plans = get_plans()
     return render_template(
         "signup.html",
         plans=plans,
@@ -222,7 +368,16 @@ def login():
         email = request.form.get("email", "").lower().strip()
         password = request.form.get("password", "")
         user = User.query.filter_by(email=email).first()
-        if user and user.check_password(password):
+        if user:
+            password_ok = user.check_password(password)
+        else:
+            # Pay the same hashing cost so response time doesn't reveal which emails exist.
+            try:
+                _password_hasher.verify(_DUMMY_HASH, password)
+            except VerificationError:
+                pass
+            password_ok = False
+        if password_ok:
             if not user.is_verified:
                 token, token_hash = generate_verification_token()
                 user.verification_token_hash = token_hash
@@ -231,6 +386,8 @@ def login():
                 send_verification_email(user.email, token)
                 flash("Please verify your email. We just sent you a new verification link.", "error")
                 return render_template("login.html")
+            # Persist a hash upgraded by check_password.
+            db.session.commit()
             login_user(user)
             return redirect(url_for("dashboard"))
         flash("Invalid credentials.", "error")
@@ -251,37 +408,32 @@ def logout():
 def dashboard():
     start = request.args.get("start")
     end = request.args.get("end")
-    query = ReservationEmail.query
+    start_date = end_date = None
     if start:
         try:
             start_date = datetime.fromisoformat(start)
-            query = query.filter(ReservationEmail.start_date >= start_date)
         except ValueError:
             flash("Invalid start date filter.", "error")
     if end:
         try:
             end_date = datetime.fromisoformat(end) + timedelta(days=1)
-            query = query.filter(ReservationEmail.end_date < end_date)
         except ValueError:
             flash("Invalid end date filter.", "error")
-    reservations = query.order_by(ReservationEmail.start_date.desc()).all()
-
-    tolls = TollRecord.query.order_by(TollRecord.entry_time.desc()).all()
-    matched = []
-    for reservation in reservations:
-        matches = [
-            toll
-            for toll in tolls
-            if toll.plate.lower() == reservation.plate.lower()
-            and reservation.start_date <= toll.entry_time <= reservation.end_date
-        ]
-        matched.append(
-            {
-                "reservation": reservation,
-                "tolls": matches,
-                "total": sum(t.amount for t in matches),
-            }
+    matched = get_matched_reservations(start_date, end_date)
+    reservations = [item["reservation"] for item in matched]
+    tolls = (
+        db.session.query(
+            TollRecord.plate,
+            TollRecord.location,
+            TollRecord.entry_time,
+            TollRecord.exit_time,
+            TollRecord.amount,
         )
+        .filter(*toll_window_filters(start_date, end_date))
+        .order_by(TollRecord.entry_time.desc())
+        .limit(RECENT_TOLL_LIMIT)
+        .all()
+    )
 
     return render_template(
         "dashboard.html",
@@ -296,16 +448,11 @@ def dashboard():
 
 def ingest_email():
     email_body = request.form.get("email_body", "")
-    emails = [chunk for chunk in email_body.split("-----") if chunk.strip()]
-    ingested = 0
-    for chunk in emails:
-        parsed = parse_reservation_email(chunk)
-        if parsed:
-            reservation = ReservationEmail(**parsed)
-            db.session.add(reservation)
-            ingested += 1
-    db.session.commit()
-    flash(f"Ingested {ingested} reservation email(s).", "success")
+    rows = [parsed for chunk in iter_email_chunks(email_body) if (parsed := parse_reservation_email(chunk))]
+    if rows:
+        db.session.bulk_insert_mappings(ReservationEmail, rows)
+        db.session.commit()
+    flash(f"Ingested {len(rows)} reservation email(s).", "success")
     return redirect(url_for("dashboard"))
 
 
@@ -314,7 +461,7 @@ def ingest_email():
 
 def sync_tolls():
     sample = TollRecord(
-        plate=request.form.get("plate", "CO1234"),
+        plate=normalize_plate(request.form.get("plate", "CO1234")),
         entry_time=datetime.utcnow(),
         exit_time=datetime.utcnow(),
         location="E-470 / ExpressToll",
@@ -344,26 +491,30 @@ def buy_credits():
 def export_csv():
     if not consume_credit():
         return redirect(url_for("dashboard"))
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["Booking", "Plate", "Start", "End", "Toll total"])
-    for item in get_matched_reservations():
-        reservation = item["reservation"]
-        writer.writerow(
-            [
-                reservation.booking_id,
-                reservation.plate,
-                reservation.start_date.strftime("%Y-%m-%d"),
-                reservation.end_date.strftime("%Y-%m-%d"),
-                f"{item['total']:.2f}",
-            ]
-        )
-    output.seek(0)
-    return send_file(
-        io.BytesIO(output.getvalue().encode("utf-8")),
+
+    def generate():
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(["Booking", "Plate", "Start", "End", "Toll total"])
+        yield output.getvalue()
+        for row in get_export_rows():
+            output.seek(0)
+            output.truncate(0)
+            writer.writerow(
+                [
+                    row.booking_id,
+                    row.plate,
+                    row.start_date.strftime("%Y-%m-%d"),
+                    row.end_date.strftime("%Y-%m-%d"),
+                    f"{row.total:.2f}",
+                ]
+            )
+            yield output.getvalue()
+
+    return Response(
+        stream_with_context(generate()),
         mimetype="text/csv",
-        as_attachment=True,
-        download_name="turo-tolls.csv",
+        headers={"Content-Disposition": "attachment; filename=turo-tolls.csv"},
     )
 
 
@@ -382,12 +533,11 @@ def export_pdf():
     pdf.drawString(50, 750, "Turo Toll Reconciliation Invoice")
     pdf.setFont("Helvetica", 10)
     y = 720
-    for item in get_matched_reservations():
-        reservation = item["reservation"]
+    for row in get_export_rows():
         line = (
-            f"{reservation.booking_id} | {reservation.plate} | "
-            f"{reservation.start_date:%Y-%m-%d} - "
-            f"{reservation.end_date:%Y-%m-%d} | ${item['total']:.2f}"
+            f"{row.booking_id} | {row.plate} | "
+            f"{row.start_date:%Y-%m-%d} - "
+            f"{row.end_date:%Y-%m-%d} | ${row.total:.2f}"
         )
         pdf.drawString(50, y, line)
         y -= 16
@@ -419,31 +569,36 @@ def admin():
         plan = request.form.get("plan", "Colorado Starter")
         fleet_size = int(request.form.get("fleet_size", 1))
         credits = int(request.form.get("credits", 10))
-        if not Plan.query.filter_by(name=plan).first():
+        if plan not in _PLAN_NAMES:
             plan = "Colorado Starter"
-        if User.query.filter_by(email=email).first():
+        if not is_strong_password(password):
+            flash("Password must be at least 8 characters and include a letter and a number.", "error")
+            return redirect(url_for("admin"))
+        user = User(
+            email=email,
+            role=role,
+            plan=plan,
+            fleet_size=fleet_size,
+            credits=credits,
+        )
+        user.set_password(password)
+        token, token_hash = generate_verification_token()
+        user.verification_token_hash = token_hash
+        user.verification_sent_at = datetime.utcnow()
+        db.session.add(user)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
             flash("Email already exists.", "error")
         else:
-            if not is_strong_password(password):
-                flash("Password must be at least 8 characters and include a letter and a number.", "error")
-                return redirect(url_for("admin"))
-            user = User(
-                email=email,
-                role=role,
-                plan=plan,
-                fleet_size=fleet_size,
-                credits=credits,
-            )
-            user.set_password(password)
-            token, token_hash = generate_verification_token()
-            user.verification_token_hash = token_hash
-            user.verification_sent_at = datetime.utcnow()
-            db.session.add(user)
-            db.session.commit()
             send_verification_email(user.email, token)
             flash("User created.", "success")
-    users = User.query.order_by(User.created_at.desc()).all()
-    plans = Plan.query.order_by(Plan.price.asc()).all()
+    users = User.query.order_by(User.created_at.desc()).paginate(
+        per_page=request.args.get("per_page", ADMIN_USERS_PER_PAGE, type=int),
+        max_per_page=200,
+    )
+    plans = get_plans()
     return render_template(
         "admin.html",
         users=users,
@@ -458,7 +613,7 @@ def admin_update_user(user_id):
     if current_user.role != "admin":
         flash("Admin access required.", "error")
         return redirect(url_for("dashboard"))
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
 
     email = request.form.get("email", "").lower().strip()
     role = request.form.get("role", "subscriber")
@@ -479,7 +634,7 @@ def admin_update_user(user_id):
         return redirect(url_for("admin"))
 
     user.email = email
-    if not Plan.query.filter_by(name=plan).first():
+    if plan not in _PLAN_NAMES:
         plan = "Colorado Starter"
     user.role = role
     user.plan = plan
@@ -505,7 +660,7 @@ def admin_delete_user(user_id):
     if current_user.id == user_id:
         flash("You cannot delete your own admin account.", "error")
         return redirect(url_for("admin"))
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     db.session.delete(user)
     db.session.commit()
     flash("User deleted.", "success")
@@ -518,7 +673,7 @@ def admin_update_plan(plan_id):
     if current_user.role != "admin":
         flash("Admin access required.", "error")
         return redirect(url_for("dashboard"))
-    plan = Plan.query.get_or_404(plan_id)
+    plan = db.get_or_404(Plan, plan_id)
     try:
         price = int(request.form.get("price", plan.price))
     except ValueError:
@@ -529,6 +684,7 @@ def admin_update_plan(plan_id):
         return redirect(url_for("admin"))
     plan.price = price
     db.session.commit()
+    refresh_plans()
     flash("Plan updated.", "success")
     return redirect(url_for("admin"))
 
@@ -537,16 +693,17 @@ def admin_update_plan(plan_id):
 def verify_email():
     token = request.args.get("token", "")
     token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()
-    user = User.query.filter_by(verification_token_hash=token_hash).first()
-    if not user:
+    cutoff = datetime.utcnow() - timedelta(hours=24)
+    user = User.query.filter(
+        User.verification_token_hash == token_hash,
+        User.verification_sent_at >= cutoff,
+    ).first()
+    if not user or not hmac.compare_digest(user.verification_token_hash or "", token_hash):
         flash("Invalid or expired verification link.", "error")
         return redirect(url_for("login"))
     if user.is_verified:
         flash("Account already verified. Please log in.", "success")
         return redirect(url_for("login"))
-    if user.verification_sent_at and datetime.utcnow() - user.verification_sent_at > timedelta(hours=24):
-        flash("Verification link expired. Please contact support.", "error")
-        return redirect(url_for("login"))
     user.is_verified = True
     user.verification_token_hash = None
     user.verification_sent_at = None
@@ -569,7 +726,30 @@ def send_verification_email(to_email: str, token: str) -> None:
         f"{verify_url}\n\n"
         "This link expires in 24 hours."
     )
-    send_email(to_email, subject, body)
+    start_mail_worker()
+    _mail_queue.put((to_email, subject, body))
+
+
+def start_mail_worker() -> None:
+    # Started on first use and re-checked each time: threads don't survive
+    # fork(), so a preloaded gunicorn worker inherits a dead handle.
+    global _mail_worker
+    with _mail_worker_lock:
+        if _mail_worker is not None and _mail_worker.is_alive():
+            return
+        _mail_worker = threading.Thread(target=run_mail_worker, name="mail-worker", daemon=True)
+        _mail_worker.start()
+
+
+def run_mail_worker() -> None:
+    while True:
+        to_email, subject, body = _mail_queue.get()
+        try:
+            send_email(to_email, subject, body)
+        except Exception:
+            app.logger.exception("Failed to send email to %s", to_email)
+        finally:
+            _mail_queue.task_done()
 
 
 def send_email(to_email: str, subject: str, body: str) -> None:
@@ -590,33 +770,119 @@ def send_email(to_email: str, subject: str, body: str) -> None:
     message["Subject"] = subject
     message.set_content(body)
 
-    with smtplib.SMTP(host, port) as server:
-        if use_tls:
-            server.starttls()
-        server.login(user, password)
+    server = get_smtp_connection(host, port, use_tls, user, password)
+    try:
         server.send_message(message)
+    except (smtplib.SMTPServerDisconnected, OSError):
+        close_smtp_connection(server)
+        raise
+
+
+def get_smtp_connection(host: str, port: int, use_tls: bool, user: str, password: str) -> smtplib.SMTP:
+    server = getattr(_smtp_local, "conn", None)
+    if server is not None:
+        try:
+            if server.noop()[0] == 250:
+                return server
+        except (smtplib.SMTPException, OSError):
+            pass
+        close_smtp_connection(server)
+    server = smtplib.SMTP(host, port)
+    if use_tls:
+        server.starttls()
+    server.login(user, password)
+    _smtp_local.conn = server
+    with _smtp_lock:
+        _smtp_connections.add(server)
+    return server
+
+
+def close_smtp_connection(server: smtplib.SMTP) -> None:
+    if getattr(_smtp_local, "conn", None) is server:
+        _smtp_local.conn = None
+    with _smtp_lock:
+        _smtp_connections.discard(server)
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+
+@atexit.register
+def close_smtp_connections() -> None:
+    with _smtp_lock:
+        servers = list(_smtp_connections)
+    for server in servers:
+        close_smtp_connection(server)
 
 
 def is_strong_password(password: str) -> bool:
     if len(password) < 8:
         return False
-    if not re.search(r"[A-Za-z]", password):
-        return False
-    if not re.search(r"\d", password):
-        return False
-    return True
+    has_letter = has_digit = False
+    for char in password:
+        if char in string.ascii_letters:
+            has_letter = True
+        elif char.isdecimal():
+            has_digit = True
+        if has_letter and has_digit:
+            return True
+    return False
+
+
+
+def iter_email_chunks(body: str):
+    start = 0
+    for match in _CHUNK_DELIMITER_RE.finditer(body):
+        chunk = body[start:match.start()]
+        if chunk.strip():
+            yield chunk
+        start = match.end()
+    chunk = body[start:]
+    if chunk.strip():
+        yield chunk
+
+
+
+def normalize_plate(plate: str) -> str:
+    return plate.strip().upper()
+
+
+
+@lru_cache(maxsize=4096)
+def parse_iso_datetime(value: str) -> datetime:
+    return datetime.fromisoformat(value)
+
+
+
+def parse_fields(body: str) -> dict[str, str]:
+    fields = {}
+    for match in _FIELD_RE.finditer(body):
+        fields.setdefault(match.group(1).strip().lower(), match.group(2).strip())
+    return fields
+
+
+
+def lookup_field(fields: dict[str, str], label: str):
+    # Labels match by prefix, so "Start date:" still counts as "Start".
+    label = label.lower()
+    for key, value in fields.items():
+        if key.startswith(label):
+            return value
+    return None
 
 
 
 def parse_reservation_email(body: str):
-    booking_id = extract_value(body, "Booking ID") or extract_value(body, "Reservation")
-    guest_name = extract_value(body, "Guest")
-    plate = extract_value(body, "Plate") or "CO1234"
-    start = extract_value(body, "Start") or extract_value(body, "Pickup")
-    end = extract_value(body, "End") or extract_value(body, "Return")
+    fields = parse_fields(body)
+    booking_id = lookup_field(fields, "Booking ID") or lookup_field(fields, "Reservation")
+    guest_name = lookup_field(fields, "Guest")
+    plate = normalize_plate(lookup_field(fields, "Plate") or "CO1234")
+    start = lookup_field(fields, "Start") or lookup_field(fields, "Pickup")
+    end = lookup_field(fields, "End") or lookup_field(fields, "Return")
     try:
-        start_date = datetime.fromisoformat(start)
-        end_date = datetime.fromisoformat(end)
+        start_date = parse_iso_datetime(start)
+        end_date = parse_iso_datetime(end)
     except (TypeError, ValueError):
         return None
     return {
@@ -630,44 +896,112 @@ def parse_reservation_email(body: str):
 
 
 
-def extract_value(body: str, label: str):
-    for line in body.splitlines():
-        if line.lower().startswith(label.lower()):
-            parts = line.split(":", 1)
-            if len(parts) == 2:
-                return parts[1].strip()
-    return None
+def toll_match_condition():
+    return and_(
+        TollRecord.plate == ReservationEmail.plate,
+        TollRecord.entry_time.between(ReservationEmail.start_date, ReservationEmail.end_date),
+    )
 
 
 
-def get_matched_reservations():
-    reservations = ReservationEmail.query.order_by(ReservationEmail.start_date.desc()).all()
-    tolls = TollRecord.query.order_by(TollRecord.entry_time.desc()).all()
-    matched = []
-    for reservation in reservations:
-        matches = [
-            toll
-            for toll in tolls
-            if toll.plate.lower() == reservation.plate.lower()
-            and reservation.start_date <= toll.entry_time <= reservation.end_date
-        ]
-        matched.append(
-            {
-                "reservation": reservation,
-                "tolls": matches,
-                "total": sum(t.amount for t in matches),
-            }
+def toll_window_filters(start_date=None, end_date=None):
+    filters = []
+    if start_date:
+        filters.append(TollRecord.entry_time >= start_date)
+    if end_date:
+        filters.append(TollRecord.entry_time < end_date)
+    return filters
+
+
+
+def get_matched_reservations(start_date=None, end_date=None):
+    version = get_data_version()
+    entry = _matched_cache.get((start_date, end_date))
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    filters = []
+    if start_date:
+        filters.append(ReservationEmail.start_date >= start_date)
+    if end_date:
+        filters.append(ReservationEmail.end_date < end_date)
+    # Plain rows rather than ORM entities, so templates can't trigger lazy loads.
+    matched = [
+        {"reservation": row, "tolls": [], "total": row.total}
+        for row in get_reservation_totals(*filters)
+    ]
+    by_id = {item["reservation"].id: item for item in matched}
+    # The two SELECTs don't share a transaction, so ignore reservations
+    # committed after the totals were read.
+    rows = (
+        db.session.query(ReservationEmail.id, TollRecord.location, TollRecord.amount)
+        .join(TollRecord, toll_match_condition())
+        .filter(
+            ReservationEmail.id <= max(by_id, default=0),
+            *filters,
+            *toll_window_filters(start_date, end_date),
         )
+        .order_by(TollRecord.entry_time.desc())
+        .all()
+    )
+    for row in rows:
+        item = by_id.get(row.id)
+        if item is not None:
+            item["tolls"].append(row)
+    if len(_matched_cache) >= MATCHED_CACHE_SIZE:
+        _matched_cache.clear()
+    _matched_cache[(start_date, end_date)] = (version, matched)
     return matched
 
 
 
+def get_reservation_totals(*filters):
+    return (
+        db.session.query(
+            ReservationEmail.id,
+            ReservationEmail.booking_id,
+            ReservationEmail.guest_name,
+            ReservationEmail.plate,
+            ReservationEmail.start_date,
+            ReservationEmail.end_date,
+            func.coalesce(func.sum(TollRecord.amount), 0).label("total"),
+        )
+        .outerjoin(TollRecord, toll_match_condition())
+        .filter(*filters)
+        .group_by(ReservationEmail.id)
+        .order_by(ReservationEmail.start_date.desc(), ReservationEmail.id)
+        .all()
+    )
+
+
+
+def get_data_version():
+    # Reservations and tolls are append-only, so the highest ids identify the data.
+    return (
+        db.session.query(func.max(ReservationEmail.id)).scalar(),
+        db.session.query(func.max(TollRecord.id)).scalar(),
+    )
+
+
+
+def get_export_rows():
+    version = get_data_version()
+    entry = _export_cache["entry"]
+    if entry is None or entry[0] != version:
+        entry = (version, get_reservation_totals())
+        _export_cache["entry"] = entry
+    return entry[1]
+
+
+
 def consume_credit():
-    if current_user.credits <= 0:
+    # One conditional UPDATE, so concurrent exports can't both spend the last credit.
+    updated = User.query.filter(User.id == current_user.id, User.credits > 0).update(
+        {User.credits: User.credits - 1}, synchronize_session=False
+    )
+    db.session.commit()
+    if not updated:
         flash("You are out of credits. Please purchase more to export.", "error")
         return False
-    current_user.credits -= 1
-    db.session.commit()
     flash("Export queued. One credit used.", "success")
     return True
 
@@ -676,5 +1010,10 @@ with app.app_context():
     initialize_database()
 
 if __name__ == "__main__":
-    debug_mode = os.environ.get("FLASK_DEBUG") == "1"
-    app.run(debug=debug_mode, host="0.0.0.0", port=5000)
+    if os.environ.get("APP_SERVER") == "waitress":
+        from waitress import serve
+
+        serve(app, host="0.0.0.0", port=5000, threads=int(os.environ.get("APP_THREADS", "8")))
+    else:
+        debug_mode = os.environ.get("FLASK_DEBUG") == "1"
+        app.run(debug=debug_mode, host="0.0.0.0", port=5000)